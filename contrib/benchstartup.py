@@ -0,0 +1,113 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Startup time benchmark for juramotecli.
+
+Measures wall time of fresh interpreters importing the modules and running a
+single command against a replayed recording, i.e. time to first command
+without hardware. Also verifies the literal coding tables against the
+reference coder first. Usage: python contrib/benchstartup.py [runs]
+"""
+
+import os, sys, subprocess, tempfile, time, statistics
+
+sys.path.insert (0, os.path.join (os.path.dirname (__file__), '..'))
+
+from juramote.com import Raw
+from juramote.transport import RecordingSerial
+
+class Loopback:
+    """
+    Answers every command with ok:
+    """
+
+    timeout = 30
+
+    def __init__ (self):
+        self.pending = b''
+
+    def write (self, data):
+        if Raw._decode ([data[i:i+4] for i in range (0, len (data), 4)]).endswith (b'\n'):
+            self.pending = b''.join (Raw._encode (b'ok:\r\n'))
+        return len (data)
+
+    def read (self, size=1):
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+    def reset_input_buffer (self):
+        pass
+
+    def reset_output_buffer (self):
+        pass
+
+    def close (self):
+        pass
+
+def verify ():
+    """
+    Check Raw.ENCODE/Raw.DECODE against _encodebyte/_decodebyte
+    """
+    for b in range (256):
+        orig = bytes ([b])
+        enc = Raw._encodebyte (orig)
+        assert Raw.ENCODE[b] == enc, (orig, Raw.ENCODE[b], enc)
+        assert Raw._decodebyte (enc) == orig, (orig, enc)
+        assert Raw._decode ([enc]) == orig, (orig, enc)
+    assert len (Raw.DECODE) == 256
+    msg = bytes (range (256))
+    assert Raw._decode (Raw._encode (msg)) == msg
+
+def record (path):
+    s = RecordingSerial (Loopback (), path)
+    Raw (s).resetDisplay ()
+    s.close ()
+
+def measure (args, runs):
+    env = dict (os.environ, PYTHONPATH=os.path.join (os.path.dirname (__file__), '..'))
+    times = []
+    for i in range (runs):
+        start = time.perf_counter ()
+        subprocess.run ([sys.executable] + args, env=env, check=True,
+                stdout=subprocess.DEVNULL)
+        times.append (time.perf_counter () - start)
+    return statistics.median (times)
+
+def main ():
+    runs = int (sys.argv[1]) if len (sys.argv) > 1 else 20
+    verify ()
+    with tempfile.TemporaryDirectory () as d:
+        path = os.path.join (d, 'display.jrs')
+        record (path)
+        cli = ['-c', 'import sys; from juramote.cli import main; sys.argv[0] = "juramotecli"; main ()']
+        benchmarks = [
+                ('interpreter', ['-c', 'pass']),
+                ('import juramote.com', ['-c', 'import juramote.com']),
+                ('import juramote.cli', ['-c', 'import juramote.cli']),
+                ('juramotecli --help', cli + ['--help']),
+                ('juramotecli display (replay)', cli + ['--replay', path, 'display']),
+                ]
+        for name, args in benchmarks:
+            print ('{:30s} {:7.1f} ms'.format (name, measure (args, runs)*1000))
+
+if __name__ == '__main__':
+    main ()
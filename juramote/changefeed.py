@@ -0,0 +1,149 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Counter changefeed: Poll product counters and keep a log of increments.
+"""
+
+import os, json, time, logging
+from collections import namedtuple, deque
+from threading import Lock, Thread, Event
+
+from .decorator import Busy
+from .persist import dumpJson
+
+log = logging.getLogger(__name__)
+
+Change = namedtuple ('Change', ['cursor', 'product', 'increment', 'timestamp'])
+
+class CounterFeed:
+    """
+    Periodically read counters and record deltas in a bounded log.
+
+    Every change gets a cursor, which increases monotonically. Cursor, last
+    counter values and the log are persisted before changes become visible,
+    so a restart neither loses nor double-counts increments.
+    """
+
+    # counters are 16 bit EEPROM words
+    COUNTER_MODULO = 0x10000
+    # a decrease is a wrap only if the counter was this close to overflowing
+    WRAP_MARGIN = 0x100
+
+    def __init__ (self, machine, interval=60, size=1024, path=None):
+        """
+        :param machine: Stateful machine
+        :param interval: Polling interval in seconds
+        :param size: Maximum number of changes kept
+        :param path: State file, not persisted if None
+        """
+        self.machine = machine
+        self.interval = interval
+        self.path = path
+        self.lock = Lock ()
+        self.stopped = Event ()
+        self.cursor = 0
+        self.last = {}
+        self.log = deque (maxlen=size)
+        self._load ()
+
+    def _load (self):
+        if not self.path or not os.path.exists (self.path):
+            return
+        with open (self.path) as fd:
+            state = json.load (fd)
+        self.cursor = state['cursor']
+        self.last = state['last']
+        self.log.extend (Change (*c) for c in state['log'])
+
+    def _save (self, cursor, last, changes):
+        if not self.path:
+            return
+        state = {'cursor': cursor, 'last': last,
+                'log': (list (self.log) + changes)[-self.log.maxlen:]}
+        dumpJson (self.path, state)
+
+    def _increment (self, name, prev, v):
+        if v > prev:
+            return v-prev
+        elif prev >= self.COUNTER_MODULO-self.WRAP_MARGIN and v < self.WRAP_MARGIN:
+            return v+self.COUNTER_MODULO-prev
+        # reset by service or EEPROM write, count from zero
+        log.warning ('counter {} decreased from {} to {}, assuming reset'.format (name, prev, v))
+        return v
+
+    def poll (self):
+        """
+        Read counters once and record changes, returns them
+        """
+        counters = self.machine.machine.counters
+        values = self.machine.readEepromWords (counters.values ())
+        now = time.time ()
+        with self.lock:
+            cursor = self.cursor
+            last = dict (self.last)
+            changes = []
+            for name, member in sorted (counters.items ()):
+                v = values[member]
+                prev = last.get (name)
+                if prev is not None and prev != v:
+                    increment = self._increment (name, prev, v)
+                    if increment:
+                        cursor += 1
+                        changes.append (Change (cursor, name, increment, now))
+                last[name] = v
+            if last != self.last:
+                self._save (cursor, last, changes)
+            self.cursor = cursor
+            self.last = last
+            self.log.extend (changes)
+        return changes
+
+    def changes (self, cursor=0):
+        """
+        Get changes after cursor. A cursor ahead of ours was handed out
+        before our state was lost, so all changes kept are returned and
+        reported as truncated.
+
+        :return: (changes, latest cursor, whether changes were dropped from the log)
+        """
+        with self.lock:
+            if cursor > self.cursor:
+                return list (self.log), self.cursor, True
+            ret = [c for c in self.log if c.cursor > cursor]
+            oldest = self.log[0].cursor if self.log else self.cursor+1
+            return ret, self.cursor, oldest > cursor+1
+
+    def run (self):
+        while True:
+            try:
+                self.poll ()
+            except (Busy, ValueError) as e:
+                log.warning ('reading counters failed: {}'.format (e))
+            if self.stopped.wait (self.interval):
+                break
+
+    def start (self):
+        t = Thread (target=self.run, daemon=True)
+        t.start ()
+        return t
+
+    def stop (self):
+        self.stopped.set ()
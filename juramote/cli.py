@@ -18,13 +18,20 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import sys, logging, argparse
+
 from .com import *
+from .trace import tracer
 
 class Cli:
     def __init__ (self):
         self.parser = argparse.ArgumentParser (description='Control Jura coffee maker through debug port.')
-        self.parser.add_argument('--tty', '-t', default='/dev/ttyUSB0', help='Serial port')
+        self.parser.add_argument('--tty', '-t', default='/dev/ttyUSB0', help='Serial port or URL (rfc2217://host:port, socket://host:port)')
         self.parser.add_argument('--verbose', '-v', action='store_true', help='Print debugging messages')
+        self.parser.add_argument('--record', metavar='FILE', help='Record serial traffic')
+        self.parser.add_argument('--replay', metavar='FILE', help='Replay recorded serial traffic instead of using tty')
+        self.parser.add_argument('--speed', type=float, help='Replay speed factor, as fast as possible if omitted')
+        self.parser.add_argument('--trace', metavar='FILE', help='Write Chrome trace of serial communication')
         subparsers = self.parser.add_subparsers (title='subcommands')
         for name, func in [('info', self.doInfo), ('input', self.doInput)]:
             p = subparsers.add_parser(name, help=func.__doc__)
@@ -47,13 +54,38 @@ class Cli:
         p.add_argument('value', nargs='*', help='String to be displayed or empty for reset.')
         p.set_defaults(func=self.doDisplay)
 
+        p = subparsers.add_parser ('scan', help=self.doScan.__doc__)
+        p.add_argument('--output', '-o', default='scan.jsonl', help='Results file, resumed if it exists')
+        p.add_argument('--deny', '-d', action='append', default=[], help='Never send this command')
+        p.add_argument('--timeout', type=float, default=2, help='Maximum response timeout (seconds)')
+        p.add_argument('range', nargs='+', help='Command or range like GC-GZ')
+        p.set_defaults(func=self.doScan)
+
     def run (self):
         args = self.parser.parse_args ()
         if args.verbose:
             logging.basicConfig (level=logging.DEBUG)
         if getattr (args, 'func', None):
-            machine = Raw (args.tty)
-            return args.func (machine, args)
+            if args.trace:
+                tracer.enable ()
+            if args.replay:
+                from .transport import ReplaySerial
+                tty = ReplaySerial (args.replay, args.speed)
+            else:
+                from .transport import openSerial
+                tty = openSerial (args.tty)
+            if args.record:
+                from .transport import RecordingSerial
+                tty = RecordingSerial (tty, args.record)
+            machine = Raw (tty)
+            try:
+                return args.func (machine, args)
+            finally:
+                tty.close ()
+                if args.trace:
+                    import json
+                    with open (args.trace, 'w') as fd:
+                        json.dump (tracer.export (), fd)
         else:
             self.parser.print_usage ()
             return 1
@@ -62,22 +94,25 @@ class Cli:
         """
         Display machine status
         """
+        import json
         data = {'type': machine.getType (), 'loader': machine.getLoader (), 'counter': {}}
-        for name, member in ImpressaXs90Eeprom.__members__.items():
-            if name.startswith ('COUNT_'):
-                data['counter'][name[6:]] = machine.readEeprom (member)
+        counters = machine.machine.counters
+        values = machine.readEepromWords (counters.values ())
+        for name, member in counters.items ():
+            data['counter'][name] = values[member]
         json.dump (data, sys.stdout, indent=4)
 
     def doEeprom (self, machine, args):
         """
         Dump EEPROM
         """
+        import json
         if args.address is not None:
             print (hex (machine.readEeprom (args.address)))
         else:
             data = []
             for offset in range (0, machine.EEPROM_LINES):
-                data.append (codecs.encode (machine.readEepromLine (offset*(machine.EEPROM_LINELENGTH//machine.EEPROM_WORDLENGTH)), 'hex').decode ('ascii'))
+                data.append (machine.readEepromLine (offset*(machine.EEPROM_LINELENGTH//machine.EEPROM_WORDLENGTH)).hex ())
             json.dump (data, sys.stdout, indent=4)
 
     def doDisplay (self, machine, args):
@@ -98,6 +133,18 @@ class Cli:
         """
         print (machine.readInput ())
 
+    def doScan (self, machine, args):
+        """
+        Probe for undocumented commands
+        """
+        from .scan import Scanner
+        scanner = Scanner (machine, args.output, deny=args.deny, maxTimeout=args.timeout)
+        commands = []
+        for r in args.range:
+            commands.extend (scanner.expand (r))
+        for r in scanner.scan (commands):
+            print (r.command, r.kind, r.response or '')
+
     def doButton (self, machine, args):
         """
         Press a button
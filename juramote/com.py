@@ -18,16 +18,55 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import serial, time, sys, logging, argparse, json, codecs
-from functools import wraps
+import time, logging
 from enum import IntEnum, Enum
 from datetime import datetime, timedelta
 from threading import Lock
 from collections import namedtuple
+from itertools import combinations
 from .decorator import locked
+from .trace import tracer, NULL_SPAN
 
 log = logging.getLogger(__name__)
 
+# Jura coding of bytes 0…255, four bytes each, see Raw._encodebyte. Verified
+# by contrib/benchstartup.py.
+CODING_TABLE = bytes.fromhex (
+        'dbdbdbdbdfdbdbdbfbdbdbdbffdbdbdbdbdfdbdbdfdfdbdbfbdfdbdbffdfdbdb'
+        'dbfbdbdbdffbdbdbfbfbdbdbfffbdbdbdbffdbdbdfffdbdbfbffdbdbffffdbdb'
+        'dbdbdfdbdfdbdfdbfbdbdfdbffdbdfdbdbdfdfdbdfdfdfdbfbdfdfdbffdfdfdb'
+        'dbfbdfdbdffbdfdbfbfbdfdbfffbdfdbdbffdfdbdfffdfdbfbffdfdbffffdfdb'
+        'dbdbfbdbdfdbfbdbfbdbfbdbffdbfbdbdbdffbdbdfdffbdbfbdffbdbffdffbdb'
+        'dbfbfbdbdffbfbdbfbfbfbdbfffbfbdbdbfffbdbdffffbdbfbfffbdbfffffbdb'
+        'dbdbffdbdfdbffdbfbdbffdbffdbffdbdbdfffdbdfdfffdbfbdfffdbffdfffdb'
+        'dbfbffdbdffbffdbfbfbffdbfffbffdbdbffffdbdfffffdbfbffffdbffffffdb'
+        'dbdbdbdfdfdbdbdffbdbdbdfffdbdbdfdbdfdbdfdfdfdbdffbdfdbdfffdfdbdf'
+        'dbfbdbdfdffbdbdffbfbdbdffffbdbdfdbffdbdfdfffdbdffbffdbdfffffdbdf'
+        'dbdbdfdfdfdbdfdffbdbdfdfffdbdfdfdbdfdfdfdfdfdfdffbdfdfdfffdfdfdf'
+        'dbfbdfdfdffbdfdffbfbdfdffffbdfdfdbffdfdfdfffdfdffbffdfdfffffdfdf'
+        'dbdbfbdfdfdbfbdffbdbfbdfffdbfbdfdbdffbdfdfdffbdffbdffbdfffdffbdf'
+        'dbfbfbdfdffbfbdffbfbfbdffffbfbdfdbfffbdfdffffbdffbfffbdffffffbdf'
+        'dbdbffdfdfdbffdffbdbffdfffdbffdfdbdfffdfdfdfffdffbdfffdfffdfffdf'
+        'dbfbffdfdffbffdffbfbffdffffbffdfdbffffdfdfffffdffbffffdfffffffdf'
+        'dbdbdbfbdfdbdbfbfbdbdbfbffdbdbfbdbdfdbfbdfdfdbfbfbdfdbfbffdfdbfb'
+        'dbfbdbfbdffbdbfbfbfbdbfbfffbdbfbdbffdbfbdfffdbfbfbffdbfbffffdbfb'
+        'dbdbdffbdfdbdffbfbdbdffbffdbdffbdbdfdffbdfdfdffbfbdfdffbffdfdffb'
+        'dbfbdffbdffbdffbfbfbdffbfffbdffbdbffdffbdfffdffbfbffdffbffffdffb'
+        'dbdbfbfbdfdbfbfbfbdbfbfbffdbfbfbdbdffbfbdfdffbfbfbdffbfbffdffbfb'
+        'dbfbfbfbdffbfbfbfbfbfbfbfffbfbfbdbfffbfbdffffbfbfbfffbfbfffffbfb'
+        'dbdbfffbdfdbfffbfbdbfffbffdbfffbdbdffffbdfdffffbfbdffffbffdffffb'
+        'dbfbfffbdffbfffbfbfbfffbfffbfffbdbfffffbdffffffbfbfffffbfffffffb'
+        'dbdbdbffdfdbdbfffbdbdbffffdbdbffdbdfdbffdfdfdbfffbdfdbffffdfdbff'
+        'dbfbdbffdffbdbfffbfbdbfffffbdbffdbffdbffdfffdbfffbffdbffffffdbff'
+        'dbdbdfffdfdbdffffbdbdfffffdbdfffdbdfdfffdfdfdffffbdfdfffffdfdfff'
+        'dbfbdfffdffbdffffbfbdffffffbdfffdbffdfffdfffdffffbffdfffffffdfff'
+        'dbdbfbffdfdbfbfffbdbfbffffdbfbffdbdffbffdfdffbfffbdffbffffdffbff'
+        'dbfbfbffdffbfbfffbfbfbfffffbfbffdbfffbffdffffbfffbfffbfffffffbff'
+        'dbdbffffdfdbfffffbdbffffffdbffffdbdfffffdfdffffffbdfffffffdfffff'
+        'dbfbffffdffbfffffbfbfffffffbffffdbffffffdffffffffbffffffffffffff')
+# only bits 2 and 5 of each encoded byte carry information
+DECODE_MASK = 0x24242424
+
 class Raw:
     """
     Raw access to Jura coffee maker, no error-checking, minimal decoding
@@ -37,22 +76,42 @@ class Raw:
     EEPROM_LINELENGTH = 32 # bytes (decoded)
     EEPROM_LINES = 64
 
+    # field boundaries of hex-encoded responses, see README
+    CS_FIELDS = [(0, 4), (4, 8), (8, 9), (9, 13), (13, 19), (19, 22), (22, 25), (25, 31), (31, 35)]
+    CM_FIELDS = [(0, 1), (1, 5), (5, None)]
+
+    # cost of a word (RE:) and line (RT:) read in decoded characters on the
+    # wire, see readEepromWords. Each round trip also pays the machine’s
+    # command/response turnaround, estimated at 250 ms, which is the time of
+    # about 60 characters (four wire bytes each at 9600 baud).
+    ROUND_TRIP_COST = 60
+    WORD_READ_COST = ROUND_TRIP_COST + len ('RE:0000\r\n') + len ('re:0000\r\n')
+    LINE_READ_COST = ROUND_TRIP_COST + len ('RT:0000\r\n') + len ('rt:\r\n') + 2*EEPROM_LINELENGTH
+
+    # coding lookup tables: byte → encoded and masked encoded → byte
+    DECODE_MASK = DECODE_MASK
+    ENCODE = tuple (CODING_TABLE[i:i+4] for i in range (0, len (CODING_TABLE), 4))
+    DECODE = dict ((int.from_bytes (e, 'big') & DECODE_MASK, b) for b, e in enumerate (ENCODE))
+
     def __init__ (self, tty):
-        # XXX: auto-detect machine type
-        self.s = serial.Serial (tty, 9600, timeout=30)
-        self._test ()
+        """
+        :param tty: TTY path, pyserial URL (rfc2217://, socket://) or
+            serial.Serial-like transport, see transport.py
+        """
+        if isinstance (tty, str):
+            from .transport import openSerial
+            self.s = openSerial (tty)
+        else:
+            self.s = tty
+        # default, use detect () to select by firmware version
         self.machine = ImpressaXs90
 
-    def _test (self):
+    def detect (self):
         """
-        Simple self-test
+        Select machine descriptor based on firmware version
         """
-        for b in range (256):
-            orig = bytes ([b])
-            enc = self._encodebyte (orig)
-            dec = self._decodebyte (enc)
-            assert dec == orig, (orig, enc, dec)
-        assert self._decode (self._encode (b'RE:1234')) == b'RE:1234'
+        self.machine = detectMachine (self.getType ())
+        return self.machine
 
     @staticmethod
     def _encodebyte (c):
@@ -74,7 +133,7 @@ class Raw:
         """
         Encode byte string to Jura coding
         """
-        return list (map (lambda x: cls._encodebyte (bytes ([x])), s))
+        return [cls.ENCODE[x] for x in s]
 
     @staticmethod
     def _decodebyte (b):
@@ -96,7 +155,12 @@ class Raw:
 
     @classmethod
     def _decode (cls, s):
-        return b''.join (map (cls._decodebyte, s))
+        """
+        Decode list of 4 byte strings received from Jura machine
+        """
+        decode = cls.DECODE
+        mask = cls.DECODE_MASK
+        return bytes (decode[int.from_bytes (b, 'big') & mask] for b in s)
 
     def _send (self, command):
         """
@@ -108,25 +172,46 @@ class Raw:
         self.s.reset_output_buffer ()
 
         log.debug ('← {}'.format (command))
-        command += b'\r\n'
-        enc = self._encode (command)
-        for b in enc:
-            self.s.write (b)
+        # whole frame at once, a single packet on network transports
+        frame = b''.join (self._encode (command + b'\r\n'))
+        if tracer.enabled:
+            with tracer.span ('send', command=command[:3].decode ('latin1'), bytes=len (command)+2):
+                self.s.write (frame)
+        else:
+            self.s.write (frame)
 
     def _receive (self):
         """
         Receive single command response
         """
-        s = b''
+        if tracer.enabled:
+            with tracer.span ('receive') as span:
+                try:
+                    s = self._receiveFrame ()
+                except ValueError:
+                    span.set (timeout=True)
+                    raise
+                span.set (bytes=len (s))
+        else:
+            s = self._receiveFrame ()
+        log.debug ('→ {}'.format (s))
+        return s.rstrip (b'\r\n')
+
+    def _receiveFrame (self):
+        """
+        Receive and decode bytes up to and including line end
+        """
+        s = bytearray ()
+        decode = self.DECODE
+        mask = self.DECODE_MASK
         while True:
             b = self.s.read (4)
             if len (b) != 4:
                 raise ValueError ('response too small/timeout')
-            s += self._decodebyte (b)
+            s.append (decode[int.from_bytes (b, 'big') & mask])
             if s.endswith (b'\r\n'):
                 break
-        log.debug ('→ {}'.format (s))
-        return s.rstrip (b'\r\n')
+        return bytes (s)
 
     def _receiveInt (self, expected):
         """
@@ -154,7 +239,7 @@ class Raw:
         l = self._receive ()
         if not l.startswith (expected):
             raise ValueError ('invalid response')
-        return codecs.decode (l[len (expected):], 'hex')
+        return bytes.fromhex (l[len (expected):].decode ('ascii'))
 
     def _receiveString (self, expected):
         """
@@ -194,6 +279,36 @@ class Raw:
         self._send ('RT:{:04X}'.format (address).encode ('ascii'))
         return self._receiveBytes (b'rt:')
 
+    def readEepromWords (self, words):
+        """
+        Read multiple words from EEPROM in as few round trips as possible.
+
+        Nearby words are fetched with a single line read if that is cheaper
+        than reading them one by one, counting turnaround and characters on
+        the wire, others with word reads.
+
+        :param words: Iterable of word addresses, see readEeprom
+        :return: dict of address → value
+        """
+        lineWords = self.EEPROM_LINELENGTH//self.EEPROM_WORDLENGTH
+        totalWords = self.EEPROM_LINES*lineWords
+        pending = sorted (set (words))
+        ret = {}
+        while pending:
+            covered = [w for w in pending if w < pending[0]+lineWords]
+            if len (covered)*self.WORD_READ_COST <= self.LINE_READ_COST:
+                covered = covered[:1]
+                ret[covered[0]] = Raw.readEeprom (self, covered[0])
+            else:
+                start = min (pending[0], totalWords-lineWords)
+                line = Raw.readEepromLine (self, start)
+                for w in covered:
+                    o = (w-start)*self.EEPROM_WORDLENGTH
+                    # words are big endian, like readEeprom’s response
+                    ret[w] = int.from_bytes (line[o:o+self.EEPROM_WORDLENGTH], 'big')
+            pending = pending[len (covered):]
+        return ret
+
     def readInput (self):
         self._send (b'IC:')
         return self._receiveInt (b'ic:')
@@ -236,6 +351,49 @@ class Raw:
             v[i] = int (v[i], 16)
         return v
 
+    @staticmethod
+    def _splitHex (s, fields):
+        return [int (s[start:end], 16) for start, end in fields]
+
+    def getSensorStatus (self):
+        """
+        Get sensor status information (CS:), a superset of getHeaterSensors.
+
+        Fields: coffee heater, milk heater, unknown, brewing sensor, unknown,
+        brewing step, grinding, unknown, flow meter
+        """
+        self._send (b'CS:')
+        return self._splitHex (self._receiveString (b'cs:'), self.CS_FIELDS)
+
+    def getBrewerStatus (self):
+        """
+        Get brewer status information (CM:).
+
+        Fields: brewer selection, brewing sensor, unknown
+        """
+        self._send (b'CM:')
+        return self._splitHex (self._receiveString (b'cm:'), self.CM_FIELDS)
+
+    def _receiveList (self, expected):
+        """
+        Receive comma-separated list of (assumed) hex integers
+        """
+        return [int (x, 16) for x in self._receiveString (expected).split (',')]
+
+    def getLsStatus (self):
+        """
+        Get unknown status information (LS:)
+        """
+        self._send (b'LS:')
+        return self._receiveList (b'ls:')
+
+    def getOoStatus (self):
+        """
+        Get unknown status information (OO:)
+        """
+        self._send (b'OO:')
+        return self._receiveList (b'oo:')
+
     def resetDisplay (self):
         """
         Reset display to default
@@ -278,6 +436,11 @@ class State (Enum):
 
 MachineState = namedtuple ('MachineState', ['state', 'flow', 'coffeetemp', 'milktemp'])
 
+# fields not requested from Stateful.getStatus are None
+StatusSnapshot = namedtuple ('StatusSnapshot', ['state', 'flow', 'coffeetemp',
+        'milktemp', 'grinding', 'brewing', 'watertank', 'groundsbowl'],
+        defaults=(None, )*8)
+
 class Stateful (Raw):
     """
     Extends raw communnication by state: Thread-safety (locking), button press delay
@@ -287,15 +450,33 @@ class Stateful (Raw):
 
     BUTTON_DELAY = timedelta (milliseconds=100)
 
+    # commands providing StatusSnapshot fields, shortest response first
+    STATUS_COMMANDS = ['IC', 'CS', 'HZ']
+    STATUS_PROVIDERS = {
+            'state': {'HZ'},
+            'flow': {'HZ', 'CS'},
+            'coffeetemp': {'HZ', 'CS'},
+            'milktemp': {'HZ', 'CS'},
+            'grinding': {'CS'},
+            'brewing': {'CS'},
+            'watertank': {'IC'},
+            'groundsbowl': {'IC'},
+            }
+
     # wrapped functions
     readEeprom = locked (Raw.readEeprom)
     writeEeprom = locked (Raw.writeEeprom)
     readEepromLine = locked (Raw.readEepromLine)
+    readEepromWords = locked (Raw.readEepromWords)
     readInput = locked (Raw.readInput)
     makeComponent = locked (Raw.makeComponent)
     getType = locked (Raw.getType)
     getLoader = locked (Raw.getLoader)
     getHeaterSensors = locked (Raw.getHeaterSensors)
+    getSensorStatus = locked (Raw.getSensorStatus)
+    getBrewerStatus = locked (Raw.getBrewerStatus)
+    getLsStatus = locked (Raw.getLsStatus)
+    getOoStatus = locked (Raw.getOoStatus)
     resetDisplay = locked (Raw.resetDisplay)
     printDisplay = locked (Raw.printDisplay)
     printDisplayDefault = locked (Raw.printDisplayDefault)
@@ -315,7 +496,8 @@ class Stateful (Raw):
         wait = (self.lastButtonPress + self.BUTTON_DELAY) - datetime.now () 
         if wait > timedelta (0):
             log.debug ('waiting for next button press {}'.format (wait))
-            time.sleep (wait.total_seconds ())
+            with tracer.span ('buttonDelay') if tracer.enabled else NULL_SPAN:
+                time.sleep (wait.total_seconds ())
         self.lastButtonPress = datetime.now ()
         return super ().pressButton (i)
 
@@ -324,7 +506,8 @@ class Stateful (Raw):
         """
         Atomic read-modify-write a single eeprom word
         """
-        return Raw.writeEeprom (self, address, f (Raw.readEeprom (self, address)))
+        with tracer.span ('patchEeprom', address=address) if tracer.enabled else NULL_SPAN:
+            return Raw.writeEeprom (self, address, f (Raw.readEeprom (self, address)))
 
     def _decodeState (self, v):
         brewerOn = ((v[0] >> 6) & 1) == 0
@@ -353,19 +536,110 @@ class Stateful (Raw):
         scaler = 100/0x4c0
         return (int (v[4]*scaler), int (v[5]*scaler))
 
-    @locked
-    def getHeaterSensors (self):
-        v = Raw.getHeaterSensors (self)
+    def _decodeHeaterSensors (self, v):
         coffeetemp, milktemp = self._decodeTemperature (v)
         return MachineState (state=self._decodeState (v),
                 flow=self._decodeFlow (v), coffeetemp=coffeetemp,
                 milktemp=milktemp)
 
+    @locked
+    def getHeaterSensors (self):
+        return self._decodeHeaterSensors (Raw.getHeaterSensors (self))
+
+    @locked
+    def getHeaterSensorsRaw (self):
+        """
+        Get raw and decoded heater sensor values with a single command
+        """
+        v = Raw.getHeaterSensors (self)
+        return v, self._decodeHeaterSensors (v)
+
     def getState (self):
         return self.getHeaterSensors ().state
 
+    @classmethod
+    def _planStatus (cls, fields):
+        """
+        Find the smallest set of commands providing all fields
+        """
+        for n in range (1, len (cls.STATUS_COMMANDS)+1):
+            for commands in combinations (cls.STATUS_COMMANDS, n):
+                if all (cls.STATUS_PROVIDERS[f] & set (commands) for f in fields):
+                    return commands
+        raise ValueError ('no command provides {}'.format (fields))
+
+    @staticmethod
+    def _sensorStatusToHeater (v):
+        """
+        Map CS: fields to their HZ: equivalent, so the decoders can be reused
+        """
+        hz = [None]*10
+        hz[2] = v[3]
+        hz[3] = v[8]
+        hz[4] = v[0]
+        hz[5] = v[1]
+        return hz
+
+    @staticmethod
+    def _decodeBrewStep (v):
+        # XXX: based on observations
+        return {0: 0, 0x1ff: 1, 0x3ff: 2}.get (v, 1)
+
+    @locked
+    def getStatus (self, fields=None):
+        """
+        Get a status snapshot with as few commands as possible.
+
+        Input board bits are a single reading: The grounds bowl bit stops
+        toggling when the bowl is full, which cannot be told from a single
+        snapshot.
+
+        :param fields: StatusSnapshot fields to retrieve, all if None
+        """
+        if fields is None:
+            fields = StatusSnapshot._fields
+        for f in fields:
+            if f not in self.STATUS_PROVIDERS:
+                raise KeyError (f)
+        data = {}
+        for command in self._planStatus (fields):
+            if command == 'HZ':
+                v = Raw.getHeaterSensors (self)
+                data.update (self._decodeHeaterSensors (v)._asdict ())
+            elif command == 'CS':
+                v = Raw.getSensorStatus (self)
+                hz = self._sensorStatusToHeater (v)
+                coffeetemp, milktemp = self._decodeTemperature (hz)
+                data.update (flow=self._decodeFlow (hz),
+                        coffeetemp=coffeetemp, milktemp=milktemp,
+                        grinding=v[6] != 0, brewing=self._decodeBrewStep (v[5]))
+            elif command == 'IC':
+                v = Raw.readInput (self)
+                inp = self.machine.input
+                data.update (watertank=bool ((v >> inp.WATERTANK) & 1),
+                        groundsbowl=bool ((v >> inp.GROUNDSBOWL) & 1))
+        return StatusSnapshot (**dict ((f, data[f]) for f in fields))
+
+    def _decodeProductDefaults (self, product, values):
+        return ProductDefaults (*map (lambda x: x.decode (values[x.word]) if x else None, self.machine.products[product]))
+
     def getProductDefaults (self, product):
-        return ProductDefaults (*map (lambda x: x.get (self) if x else None, self.machine.products[product]))
+        words = [x.word for x in self.machine.products[product] if x]
+        return self._decodeProductDefaults (product, self.readEepromWords (words))
+
+    def getAllProductDefaults (self):
+        """
+        Get defaults of all products, reading every EEPROM word only once and
+        decoding all fields stored in it
+        """
+        index = self.machine.productWords
+        values = self.readEepromWords (index.keys ())
+        fields = dict ((p, dict.fromkeys (ProductDefaults._fields)) for p in self.machine.products)
+        for word, users in index.items ():
+            v = values[word]
+            for product, field, value in users:
+                fields[product][field] = value.decode (v)
+        return dict ((p, ProductDefaults (**f)) for p, f in fields.items ())
 
     def setProductDefaults (self, product, defaults):
         for eeprom, v in zip (self.machine.products[product], defaults):
@@ -378,15 +652,18 @@ class Stateful (Raw):
         """
         prev = None
         if defaults:
-            prev = self.getProductDefaults (product)
-            self.setProductDefaults (product, defaults)
+            with tracer.span ('applyDefaults', product=product.name) if tracer.enabled else NULL_SPAN:
+                prev = self.getProductDefaults (product)
+                self.setProductDefaults (product, defaults)
 
         self.pressButton (self.machine.buttons[product.name])
         # XXX: is this actually required?
-        time.sleep (1)
+        with tracer.span ('makeDelay') if tracer.enabled else NULL_SPAN:
+            time.sleep (1)
 
         if defaults:
-            self.setProductDefaults (product, prev)
+            with tracer.span ('restoreDefaults', product=product.name) if tracer.enabled else NULL_SPAN:
+                self.setProductDefaults (product, prev)
 
 class EepromValue:
     """
@@ -404,7 +681,12 @@ class EepromValue:
         """
         Retrieve value from machine
         """
-        v = machine.readEeprom (self.word)
+        return self.decode (machine.readEeprom (self.word))
+
+    def decode (self, v):
+        """
+        Extract value from EEPROM word v
+        """
         return self.unit (((v>>self.shift)&self.mask)*self.scale)
 
     def patch (self, machine, value):
@@ -490,9 +772,36 @@ class ImpressaXs90Input (IntEnum):
     """
     Bit position in status word.
     """
-    pass
+    # menu wheel on the left
+    WHEEL0 = 0
+    WHEEL1 = 1
+    WATERTANK = 8 # ?
+    GROUNDSBOWL = 10 # stops toggling if full
+
+def indexCounters (eeprom):
+    """
+    Find product counters in EEPROM address enum
+
+    :return: dict of counter name (without COUNT_ prefix) → address
+    """
+    return dict ((name[6:], member) for name, member in eeprom.__members__.items () if name.startswith ('COUNT_'))
+
+def indexProductWords (products):
+    """
+    Map EEPROM word to all product defaults fields stored in it
+
+    :return: dict of word → [(product, field, EepromValue), …]
+    """
+    ret = {}
+    for product, defaults in products.items ():
+        for field, value in defaults._asdict ().items ():
+            if value is not None:
+                ret.setdefault (value.word, []).append ((product, field, value))
+    return ret
 
 class ImpressaXs90:
+    # TY: response prefixes
+    firmware = ('EF516M', )
     buttons = ImpressaXs90Buttons
     eeprom = ImpressaXs90Eeprom
     input = ImpressaXs90Input
@@ -520,4 +829,17 @@ class ImpressaXs90:
                 temperature = None,
                 ),
         }
+ImpressaXs90.counters = indexCounters (ImpressaXs90.eeprom)
+ImpressaXs90.productWords = indexProductWords (ImpressaXs90.products)
+
+# known machines, see detectMachine
+machines = [ImpressaXs90]
 
+def detectMachine (firmware):
+    """
+    Find machine descriptor by firmware string (TY:)
+    """
+    for m in machines:
+        if firmware.startswith (m.firmware):
+            return m
+    raise KeyError (firmware)
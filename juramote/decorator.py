@@ -1,4 +1,5 @@
 from functools import wraps
+from .trace import tracer
 
 class Busy (Exception):
     pass
@@ -8,9 +9,25 @@ def locked (f):
     Per-instance locking for functions
     """
 
+    name = f.__name__
+
+    def traced (self, args, kwargs):
+        with tracer.span ('lock', function=name):
+            acquired = self.lock.acquire (timeout=self.timeout)
+        if not acquired:
+            raise Busy ()
+        try:
+            with tracer.span (name):
+                ret = f(*args, **kwargs)
+        finally:
+            self.lock.release ()
+        return ret
+
     @wraps(f)
     def decorator(*args, **kwargs):
         self = args[0]
+        if tracer.enabled:
+            return traced (self, args, kwargs)
         if not self.lock.acquire (timeout=self.timeout):
             raise Busy ()
         try:
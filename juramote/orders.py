@@ -0,0 +1,249 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Server-side product order queue
+"""
+
+import time, logging
+from collections import deque
+from itertools import count
+from threading import Condition, Thread
+
+from .com import State
+from .decorator import Busy
+
+log = logging.getLogger(__name__)
+
+class NotIdle (Exception):
+    """
+    Raised by the make function if the machine was not idle any more when the
+    product was about to be made. The order is queued again.
+    """
+    pass
+
+class Order:
+    QUEUED = 'queued'
+    MAKING = 'making'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__ (self, id, product, defaults):
+        self.id = id
+        self.product = product
+        self.defaults = defaults
+        self.state = self.QUEUED
+        self.created = time.time ()
+        self.started = None
+        self.finished = None
+        self.error = None
+
+class OrderQueue:
+    """
+    FIFO order queue, dispatching orders whenever the machine is idle.
+
+    An order is done once the machine left the idle state and returned to it.
+    Brew durations (dispatch until the machine is idle again) are tracked per
+    product as exponential moving average and used to estimate when an order
+    will be finished.
+    """
+
+    def __init__ (self, machine, make, pollInterval=1, defaultDuration=60,
+            smoothing=0.3, history=100, startTimeout=10, durationFactor=3):
+        """
+        :param machine: Stateful machine, used to poll state
+        :param make: Function making a product, called with (product, defaults)
+        :param pollInterval: Seconds between state polls while waiting
+        :param defaultDuration: Duration estimate for products never made
+        :param smoothing: Weight of the latest duration in the average
+        :param history: Number of finished orders kept for status queries
+        :param startTimeout: Fail order if the machine does not leave the idle
+            state within this many seconds
+        :param durationFactor: Fail order if the machine is not idle again
+            after this multiple of the estimated duration
+        """
+        self.machine = machine
+        self.make = make
+        self.pollInterval = pollInterval
+        self.defaultDuration = defaultDuration
+        self.smoothing = smoothing
+        self.startTimeout = startTimeout
+        self.durationFactor = durationFactor
+        self.cond = Condition ()
+        self.queue = deque ()
+        self.current = None
+        self.finished = deque (maxlen=history)
+        self.durations = {}
+        self.ids = count (1)
+
+    def submit (self, product, defaults=None):
+        with self.cond:
+            order = Order (next (self.ids), product, defaults)
+            self.queue.append (order)
+            self.cond.notify ()
+            return order
+
+    def get (self, id):
+        """
+        Find order by id, raises KeyError if unknown
+        """
+        with self.cond:
+            for o in self._all ():
+                if o.id == id:
+                    return o
+        raise KeyError (id)
+
+    def _all (self):
+        if self.current:
+            yield self.current
+        yield from self.queue
+        yield from self.finished
+
+    def cancel (self, id):
+        """
+        Cancel queued order, returns False if it is not queued any more
+        """
+        with self.cond:
+            for o in self.queue:
+                if o.id == id:
+                    self.queue.remove (o)
+                    o.state = Order.CANCELLED
+                    o.finished = time.time ()
+                    self.finished.append (o)
+                    return True
+        # raises KeyError for unknown orders
+        self.get (id)
+        return False
+
+    def estimate (self, product):
+        """
+        Estimated brew duration of product in seconds
+        """
+        return self.durations.get (product, self.defaultDuration)
+
+    def status (self, order):
+        """
+        Order status including queue position (0 is next) and seconds until it
+        is expected to be finished
+        """
+        with self.cond:
+            ret = {'id': order.id, 'product': order.product.name,
+                    'state': order.state, 'created': order.created,
+                    'started': order.started, 'finished': order.finished,
+                    'error': order.error, 'position': None, 'eta': None}
+            now = time.time ()
+            eta = 0
+            if self.current:
+                eta = max (0, self.current.started + self.estimate (self.current.product) - now)
+            if order is self.current:
+                ret['eta'] = eta
+            elif order.state == Order.QUEUED:
+                for i, o in enumerate (self.queue):
+                    eta += self.estimate (o.product)
+                    if o is order:
+                        ret['position'] = i
+                        ret['eta'] = eta
+                        break
+            return ret
+
+    def busy (self):
+        """
+        True while an order is being made or waiting to be made
+        """
+        with self.cond:
+            return bool (self.current or self.queue)
+
+    def list (self):
+        with self.cond:
+            orders = ([self.current] if self.current else []) + list (self.queue)
+        return [self.status (o) for o in orders]
+
+    def _waitIdle (self, idle=True, timeout=None):
+        """
+        Wait until the machine is (not) idle, returns False on timeout
+        """
+        deadline = time.monotonic () + timeout if timeout is not None else None
+        while True:
+            try:
+                if (self.machine.getState () == State.IDLE) == idle:
+                    return True
+            except (Busy, ValueError) as e:
+                log.debug ('polling state failed: {}'.format (e))
+            if deadline is not None and time.monotonic () >= deadline:
+                return False
+            time.sleep (self.pollInterval)
+
+    def _update (self, product, duration):
+        prev = self.durations.get (product)
+        if prev is None:
+            self.durations[product] = duration
+        else:
+            self.durations[product] = self.smoothing*duration + (1-self.smoothing)*prev
+
+    def run (self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait ()
+                order = self.queue[0]
+
+            self._waitIdle ()
+
+            with self.cond:
+                if not self.queue or self.queue[0] is not order:
+                    # cancelled while waiting
+                    continue
+                self.queue.popleft ()
+                order.state = Order.MAKING
+                order.started = time.time ()
+                self.current = order
+
+            try:
+                self.make (order.product, order.defaults)
+                if not self._waitIdle (False, self.startTimeout):
+                    raise ValueError ('machine did not start making the product')
+                if not self._waitIdle (True, self.durationFactor*self.estimate (order.product)):
+                    raise ValueError ('machine did not finish in time')
+                order.state = Order.DONE
+            except NotIdle:
+                log.debug ('machine busy, queueing order {} again'.format (order.id))
+                with self.cond:
+                    order.state = Order.QUEUED
+                    order.started = None
+                    self.current = None
+                    self.queue.appendleft (order)
+                continue
+            except Exception as e:
+                log.error ('order {} failed: {}'.format (order.id, e))
+                order.state = Order.FAILED
+                order.error = str (e) or type (e).__name__
+
+            with self.cond:
+                order.finished = time.time ()
+                if order.state == Order.DONE:
+                    self._update (order.product, order.finished - order.started)
+                self.current = None
+                self.finished.append (order)
+
+    def start (self):
+        t = Thread (target=self.run, daemon=True)
+        t.start ()
+        return t
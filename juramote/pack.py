@@ -0,0 +1,96 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Minimal MessagePack encoder, see https://msgpack.org/
+
+Supports None, bool, int, float, str, bytes, lists/tuples and dicts, which is
+all the HTTP API returns.
+"""
+
+import struct
+
+def _pack (o, out):
+    if o is None:
+        out.append (b'\xc0')
+    elif o is True:
+        out.append (b'\xc3')
+    elif o is False:
+        out.append (b'\xc2')
+    elif isinstance (o, int):
+        if 0 <= o < 0x80:
+            out.append (struct.pack ('B', o))
+        elif -0x20 <= o < 0:
+            out.append (struct.pack ('b', o))
+        elif o >= 0:
+            for fmt, tag in (('>B', 0xcc), ('>H', 0xcd), ('>I', 0xce), ('>Q', 0xcf)):
+                if o < 1 << (struct.calcsize (fmt)*8):
+                    out.append (struct.pack ('B', tag) + struct.pack (fmt, o))
+                    break
+            else:
+                raise OverflowError (o)
+        else:
+            for fmt, tag in (('>b', 0xd0), ('>h', 0xd1), ('>i', 0xd2), ('>q', 0xd3)):
+                if o >= -(1 << (struct.calcsize (fmt)*8-1)):
+                    out.append (struct.pack ('B', tag) + struct.pack (fmt, o))
+                    break
+            else:
+                raise OverflowError (o)
+    elif isinstance (o, float):
+        out.append (b'\xcb' + struct.pack ('>d', o))
+    elif isinstance (o, str):
+        o = o.encode ('utf8')
+        _header (len (o), out, 0xa0, 32, (0xd9, 0xda, 0xdb))
+        out.append (o)
+    elif isinstance (o, (bytes, bytearray)):
+        _header (len (o), out, None, 0, (0xc4, 0xc5, 0xc6))
+        out.append (bytes (o))
+    elif isinstance (o, (list, tuple)):
+        _header (len (o), out, 0x90, 16, (None, 0xdc, 0xdd))
+        for x in o:
+            _pack (x, out)
+    elif isinstance (o, dict):
+        _header (len (o), out, 0x80, 16, (None, 0xde, 0xdf))
+        for k, v in o.items ():
+            _pack (k, out)
+            _pack (v, out)
+    else:
+        raise TypeError ('cannot pack {}'.format (type (o)))
+
+def _header (l, out, fix, fixlimit, tags):
+    """
+    Length header: fix type if l < fixlimit, else 8, 16 or 32 bit length
+    """
+    if l < fixlimit:
+        out.append (struct.pack ('B', fix | l))
+        return
+    for fmt, tag in zip (('>B', '>H', '>I'), tags):
+        if tag is not None and l < 1 << (struct.calcsize (fmt)*8):
+            out.append (struct.pack ('B', tag) + struct.pack (fmt, l))
+            return
+    raise OverflowError (l)
+
+def packb (o):
+    """
+    Serialize o to MessagePack
+    """
+    out = []
+    _pack (o, out)
+    return b''.join (out)
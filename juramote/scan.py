@@ -0,0 +1,219 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Protocol discovery: Probe command namespaces for undocumented commands.
+"""
+
+import os, json, time, string, logging
+from collections import namedtuple
+from itertools import product
+
+log = logging.getLogger(__name__)
+
+Result = namedtuple ('Result', ['command', 'kind', 'response', 'latency'])
+
+class Scanner:
+    """
+    Probe commands with short, adaptive timeouts.
+
+    Results are appended to a JSON lines file. A response arriving after its
+    probe timed out is recorded as an additional “late” result for that
+    command. Commands already present in the file are skipped, so
+    interrupted scans can be resumed.
+    """
+
+    # switches off the machine, writes EEPROM, presses buttons, moves parts
+    DENY = {'GB', 'WE', 'FA', 'FN', 'MA', 'MJ', 'MW'}
+    # command known to be answered, used for calibration
+    CALIBRATE = 'TY'
+
+    def __init__ (self, machine, path, deny=(), minTimeout=0.2, maxTimeout=2, factor=3, decay=0.8):
+        """
+        :param machine: Raw machine
+        :param path: Results file
+        :param deny: Additional commands never sent
+        :param minTimeout: Lower bound for response timeout (seconds)
+        :param maxTimeout: Upper bound for response timeout (seconds)
+        :param factor: Timeout is this multiple of the estimated time until
+            the first byte of a response arrives
+        :param decay: Weight of the previous estimate when a response arrives
+            faster than estimated, slower responses replace it
+        """
+        self.machine = machine
+        self.path = path
+        self.deny = self.DENY | set (map (str.upper, deny))
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.factor = factor
+        self.decay = decay
+        self.timeout = maxTimeout
+        self.latency = None
+        self.last = None
+
+    @staticmethod
+    def expand (spec):
+        """
+        Expand command range like GC-GZ to list of commands
+        """
+        first, _, last = spec.upper ().partition ('-')
+        last = last or first
+        if len (first) != len (last):
+            raise ValueError ('range bounds must have the same length')
+        ret = []
+        for c in product (string.ascii_uppercase, repeat=len (first)):
+            c = ''.join (c)
+            if first <= c <= last:
+                ret.append (c)
+        return ret
+
+    def done (self):
+        """
+        Commands already in the results file. A partially written last line,
+        left by an interrupted scan, is removed, so its command is probed
+        again.
+        """
+        ret = set ()
+        if not os.path.exists (self.path):
+            return ret
+        with open (self.path, 'rb+') as fd:
+            lines = fd.readlines ()
+            offset = 0
+            for i, l in enumerate (lines):
+                last = i == len (lines)-1
+                try:
+                    command = json.loads (l.decode ('utf-8'))['command']
+                except ValueError:
+                    if not last:
+                        raise
+                    command = None
+                if last and (command is None or not l.endswith (b'\n')):
+                    log.warning ('dropping incomplete result {!r}'.format (l))
+                    fd.truncate (offset)
+                    break
+                ret.add (command)
+                offset += len (l)
+        return ret
+
+    def _write (self, result):
+        with open (self.path, 'a') as fd:
+            fd.write (json.dumps (result._asdict ()) + '\n')
+
+    def _classify (self, command, response):
+        if response is None:
+            return 'silence'
+        elif response == 'ok:':
+            return 'ok'
+        prefix = command.lower () + ':'
+        if response == prefix:
+            return 'echo'
+        elif response.startswith (prefix):
+            return 'data'
+        return 'other'
+
+    def _drain (self, timeout):
+        """
+        Read responses arriving late, returns them decoded
+        """
+        s = self.machine.s
+        s.timeout = timeout
+        data = []
+        while True:
+            b = s.read (4)
+            if len (b) != 4:
+                break
+            data.append (b)
+        return self.machine._decode (data).decode ('latin1').strip ()
+
+    def _adapt (self, latency):
+        if self.latency is None or latency > self.latency:
+            self.latency = latency
+        else:
+            self.latency = self.decay*self.latency + (1-self.decay)*latency
+        self.timeout = min (self.maxTimeout, max (self.minTimeout, self.factor*self.latency))
+
+    def _receive (self):
+        """
+        Receive response, returns it and the time until its first byte
+        arrived. Only waiting for the first byte is limited by the adaptive
+        timeout, the transfer itself by maxTimeout.
+        """
+        s = self.machine.s
+        start = time.monotonic ()
+        b = s.read (4)
+        if len (b) != 4:
+            return None, None
+        latency = time.monotonic () - start
+        s.timeout = self.maxTimeout
+        data = [b]
+        while not self.machine._decode (data[-2:]).endswith (b'\r\n'):
+            b = s.read (4)
+            if len (b) != 4:
+                # truncated
+                break
+            data.append (b)
+        return self.machine._decode (data).decode ('latin1').strip (), latency
+
+    def probe (self, command):
+        """
+        Send a single command and classify its response
+        """
+        machine = self.machine
+
+        # the previous probe timed out, give it a little more time
+        late = self._drain (self.minTimeout if self.last and self.last.kind == 'silence' else 0)
+        if late and self.last:
+            for l in late.splitlines ():
+                self._write (Result (self.last.command, 'late', l, None))
+
+        machine.s.timeout = self.timeout
+        machine._send ((command + ':').encode ('ascii'))
+        response, latency = self._receive ()
+        if latency is not None:
+            self._adapt (latency)
+        self.last = Result (command, self._classify (command, response), response, latency)
+        return self.last
+
+    def calibrate (self, n=3):
+        """
+        Measure response time of a command known to work
+        """
+        self.timeout = self.maxTimeout
+        for i in range (n):
+            self.probe (self.CALIBRATE)
+
+    def scan (self, commands):
+        """
+        Probe commands not denied and not already scanned, yields results
+        """
+        done = self.done ()
+        oldTimeout = self.machine.s.timeout
+        try:
+            self.calibrate ()
+            for c in commands:
+                if c in self.deny or c in done:
+                    continue
+                r = self.probe (c)
+                self._write (r)
+                yield r
+            # catch a late response to the last probe
+            self.probe (self.CALIBRATE)
+        finally:
+            self.machine.s.timeout = oldTimeout
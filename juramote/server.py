@@ -18,17 +18,42 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 from flask.json import jsonify
 from functools import wraps
+import logging
 from hashlib import sha512
 from threading import Timer
 import time
 
 from .com import *
+from .telemetry import Recorder, COLUMNS, packColumns
+from .changefeed import CounterFeed
+from .trace import tracer, NULL_SPAN
+from .pack import packb
+from .sticky import StickyDefaults
+from .decorator import Busy
+from .orders import OrderQueue, NotIdle
 
 class DefaultConfig:
+    # serial port or URL of a serial-over-TCP bridge (rfc2217://, socket://)
     TTY_PATH = '/dev/ttyUSB0'
+    # select machine descriptor by firmware version at startup
+    DETECT_MACHINE = False
+    # directory for brew telemetry, disabled if None
+    TELEMETRY_PATH = None
+    # counter changefeed polling interval in seconds, disabled if None, and
+    # its state file, required, so cursors survive restarts
+    COUNTER_FEED_INTERVAL = None
+    COUNTER_FEED_SIZE = 1024
+    COUNTER_FEED_PATH = None
+    # record spans for /v1/admin/trace
+    TRACE = False
+    TRACE_SIZE = 10000
+    # keep custom product defaults applied across identical orders, restore
+    # journal path, disabled if None
+    STICKY_DEFAULTS_JOURNAL = None
+    STICKY_DEFAULTS_TIMEOUT = 300
 
 app = Flask(__name__)
 app.config.from_object('juramote.server.DefaultConfig')
@@ -36,20 +61,78 @@ app.config.from_envvar('JURAMOTE_SETTINGS')
 machine = Stateful (app.config['TTY_PATH'])
 if app.config['DEBUG']:
     logging.basicConfig (level=logging.DEBUG)
+if app.config['DETECT_MACHINE']:
+    try:
+        machine.detect ()
+    except (KeyError, ValueError) as e:
+        logging.warning ('machine detection failed, using {}: {}'.format (machine.machine.__name__, e))
+if app.config['TRACE']:
+    tracer.enable (app.config['TRACE_SIZE'])
+recorder = None
+if app.config['TELEMETRY_PATH']:
+    recorder = Recorder (machine, app.config['TELEMETRY_PATH'])
+sticky = None
+if app.config['STICKY_DEFAULTS_JOURNAL']:
+    sticky = StickyDefaults (machine, app.config['STICKY_DEFAULTS_JOURNAL'],
+            app.config['STICKY_DEFAULTS_TIMEOUT'])
+    try:
+        sticky.restore ()
+    except (Busy, ValueError) as e:
+        logging.warning ('restoring product defaults failed: {}'.format (e))
+counterFeed = None
+if app.config['COUNTER_FEED_INTERVAL']:
+    if not app.config['COUNTER_FEED_PATH']:
+        raise ValueError ('COUNTER_FEED_PATH is required for the counter changefeed')
+    counterFeed = CounterFeed (machine, app.config['COUNTER_FEED_INTERVAL'],
+            app.config['COUNTER_FEED_SIZE'], app.config['COUNTER_FEED_PATH'])
+    counterFeed.start ()
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+OCTET = 'application/octet-stream'
+
+def respond (data, packed=None, binary=None):
+    """
+    Successful response in the representation preferred by the client’s
+    Accept header: JSON (default), MessagePack or raw bytes.
+
+    :param data: Response for JSON
+    :param packed: Response for MessagePack if different from data, may contain bytes
+    :param binary: Raw bytes, application/octet-stream is not offered if None
+    """
+    offers = [JSON, MSGPACK, 'application/x-msgpack']
+    if binary is not None:
+        offers.append (OCTET)
+    best = request.accept_mimetypes.best_match (offers, default=JSON)
+    if best == OCTET:
+        return Response (binary, mimetype=OCTET)
+    elif best != JSON:
+        if packed is None:
+            packed = data
+        return Response (packb ({'status': 'ok', 'response': packed}), mimetype=best)
+    return jsonify (status='ok', response=data)
 
 def authenticated (permission):
     """
     API key is required
     """
+    def check ():
+        key = request.headers.get ('X-API-Key')
+        if not key:
+            abort (401)
+        d = sha512 (key.strip ().encode ('utf8')).hexdigest ()
+        if permission not in app.config['API_KEYS'].get (d):
+            abort (401)
+
     def wrapper (f):
         @wraps(f)
         def decorator(*args, **kwargs):
-            key = request.headers.get ('X-API-Key')
-            if not key:
-                abort (401)
-            d = sha512 (key.strip ().encode ('utf8')).hexdigest ()
-            if permission not in app.config['API_KEYS'].get (d):
-                abort (401)
+            if tracer.enabled:
+                with tracer.span (f.__name__, path=request.path):
+                    with tracer.span ('auth'):
+                        check ()
+                    return f(*args, **kwargs)
+            check ()
             return f(*args, **kwargs)
         return decorator
     return wrapper
@@ -57,10 +140,10 @@ def authenticated (permission):
 @app.route ('/v1/raw/eeprom', methods=['GET'])
 @authenticated('rraw')
 def rawEepromFull ():
-    data = []
+    lines = []
     for offset in range (0, machine.EEPROM_LINES):
-        data.append (codecs.encode (machine.readEepromLine (offset*(machine.EEPROM_LINELENGTH//machine.EEPROM_WORDLENGTH)), 'hex').decode ('ascii'))
-    return jsonify (status='ok', response=data)
+        lines.append (machine.readEepromLine (offset*(machine.EEPROM_LINELENGTH//machine.EEPROM_WORDLENGTH)))
+    return respond ([l.hex () for l in lines], packed=lines, binary=b''.join (lines))
 
 @app.route ('/v1/raw/eeprom/<int:address>', methods=['GET'])
 @authenticated('rraw')
@@ -121,13 +204,21 @@ def firmware ():
 @authenticated('r')
 def counter ():
     try:
-        data = {}
-        for name, member in machine.machine.eeprom.__members__.items():
-            if name.startswith ('COUNT_'):
-                data[name[6:]] = machine.readEeprom (member)
+        counters = machine.machine.counters
+        values = machine.readEepromWords (counters.values ())
+        data = dict ((name, values[member]) for name, member in counters.items ())
     except ValueError:
         abort (500)
-    return jsonify (status='ok', response=data)
+    return respond (data)
+
+@app.route ('/v1/counter/changes', methods=['GET'])
+@authenticated('r')
+def counterChanges ():
+    if not counterFeed:
+        abort (404)
+    changes, cursor, truncated = counterFeed.changes (request.args.get ('cursor', 0, int))
+    changes = [c._asdict () for c in changes]
+    return respond ({'changes': changes, 'cursor': cursor, 'truncated': truncated})
 
 @app.route ('/v1/status', methods=['GET'])
 @authenticated('r')
@@ -136,11 +227,37 @@ def status ():
     data['state'] = data['state'].name
     return jsonify (status='ok', response=data)
 
+@app.route ('/v1/status/full', methods=['GET'])
+@authenticated('r')
+def statusFull ():
+    fields = request.args.get ('fields', None)
+    if fields:
+        fields = fields.split (',')
+    try:
+        data = machine.getStatus (fields)._asdict ()
+    except KeyError:
+        abort (400)
+    except ValueError:
+        abort (504)
+    if data['state'] is not None:
+        data['state'] = data['state'].name
+    return jsonify (status='ok', response=data)
+
 @app.route ('/v1/product', methods=['GET'])
 @authenticated('r')
 def listProducts ():
     return jsonify (status='ok', response=list (map (lambda x: x.name, machine.machine.products.keys ())))
 
+@app.route ('/v1/product/defaults', methods=['GET'])
+@authenticated('r')
+def getAllProductDefaults ():
+    try:
+        defaults = machine.getAllProductDefaults ()
+    except ValueError:
+        abort (504)
+    data = dict ((name.name, d._asdict ()) for name, d in defaults.items ())
+    return respond (data)
+
 @app.route ('/v1/product/<name>/defaults', methods=['GET'])
 @authenticated('r')
 def getProductDefaults (name):
@@ -166,6 +283,47 @@ def display ():
 # XXX: replace with Stateful state reading (ic:)
 productInProgress = Lock ()
 
+def parseDefaults (form):
+    """
+    Product defaults overrides from form
+    """
+    defaults = {
+            'temperature': form.get ('temperature', None, Temperature),
+            'pause': form.get ('pause', None, int),
+            'milk': form.get ('milk', None, int),
+            'aroma': form.get ('aroma', None, int),
+            'water': form.get ('water', None, int),
+            }
+    return ProductDefaults (**defaults)
+
+def brew (product, defaults):
+    """
+    Make product, holding productInProgress. Raises NotIdle if the machine is
+    not idle, so nothing started in the meantime is interrupted.
+
+    :return: Telemetry brew id or None
+    """
+    with tracer.span ('productInProgress') if tracer.enabled else NULL_SPAN:
+        productInProgress.acquire ()
+    try:
+        if machine.getState () != State.IDLE:
+            raise NotIdle ()
+        telemetry = None
+        if recorder:
+            telemetry = recorder.start (product)
+        try:
+            if sticky:
+                sticky.make (product, defaults)
+            else:
+                machine.make (product, defaults)
+        except Exception:
+            if recorder:
+                recorder.stop ()
+            raise
+        return telemetry
+    finally:
+        productInProgress.release ()
+
 @app.route ('/v1/product/<name>/make', methods=['POST'])
 @authenticated('w')
 def makeProduct (name):
@@ -174,24 +332,112 @@ def makeProduct (name):
         name = Type[name]
     except KeyError:
         abort (404)
-    if machine.getState () != State.IDLE:
+    if name not in machine.machine.products:
+        abort (404)
+    # do not jump the order queue
+    if orders.busy ():
         abort (409)
-    if name in machine.machine.products:
-        form = request.form
-        defaults = {
-                'temperature': form.get ('temperature', None, Temperature),
-                'pause': form.get ('pause', None, int),
-                'milk': form.get ('milk', None, int),
-                'aroma': form.get ('aroma', None, int),
-                'water': form.get ('water', None, int),
-                }
-        defaults = ProductDefaults (**defaults)
-        with productInProgress:
-            return jsonify (status='ok', response=machine.make (name, defaults))
-    else:
+    try:
+        return jsonify (status='ok', response=brew (name, parseDefaults (request.form)))
+    except NotIdle:
+        abort (409)
+
+orders = OrderQueue (machine, brew)
+orders.start ()
+
+@app.route ('/v1/order', methods=['GET'])
+@authenticated('r')
+def listOrders ():
+    return jsonify (status='ok', response=orders.list ())
+
+@app.route ('/v1/order', methods=['POST'])
+@authenticated('w')
+def submitOrder ():
+    try:
+        name = Type[request.form.get ('product', '').upper ()]
+    except KeyError:
+        abort (404)
+    if name not in machine.machine.products:
+        abort (404)
+    order = orders.submit (name, parseDefaults (request.form))
+    return jsonify (status='ok', response=orders.status (order))
+
+@app.route ('/v1/order/<int:id>', methods=['GET'])
+@authenticated('r')
+def getOrder (id):
+    try:
+        order = orders.get (id)
+    except KeyError:
         abort (404)
+    return jsonify (status='ok', response=orders.status (order))
+
+@app.route ('/v1/order/<int:id>', methods=['DELETE'])
+@authenticated('w')
+def cancelOrder (id):
+    try:
+        if not orders.cancel (id):
+            abort (409)
+    except KeyError:
+        abort (404)
+    return jsonify (status='ok', response=orders.status (orders.get (id)))
+
+@app.route ('/v1/telemetry', methods=['GET'])
+@authenticated('r')
+def listTelemetry ():
+    if not recorder:
+        abort (404)
+    return jsonify (status='ok', response=recorder.list ())
+
+@app.route ('/v1/telemetry/<brew>', methods=['GET'])
+@authenticated('r')
+def getTelemetry (brew):
+    if not recorder:
+        abort (404)
+    try:
+        f = recorder.open (brew)
+    except KeyError:
+        abort (404)
+    args = request.args
+    samples = list (f.query (start=args.get ('start', None, float),
+            end=args.get ('end', None, float),
+            step=args.get ('step', None, float)))
+    data = {'product': f.product, 'start': f.start, 'samples': []}
+    for s in samples:
+        s = s._asdict ()
+        s['state'] = s['state'].name
+        data['samples'].append (s)
+    # column-wise like the file: one packed little endian array per field,
+    # typed by Python array typecode, and state value → name
+    packed = {'product': f.product, 'start': f.start, 'count': len (samples),
+            'types': dict (COLUMNS), 'columns': packColumns (samples),
+            'states': dict ((s.value, s.name) for s in State)}
+    return respond (data, packed)
+
+@app.route ('/v1/admin/trace', methods=['GET'])
+@authenticated('admin')
+def getTrace ():
+    # plain trace object, so it can be loaded into a trace viewer directly
+    return jsonify (tracer.export ())
+
+@app.route ('/v1/admin/trace', methods=['POST'])
+@authenticated('admin')
+def setTrace ():
+    form = request.form
+    if form.get ('clear', 0, int):
+        tracer.clear ()
+    enabled = form.get ('enabled', None, int)
+    if enabled is not None:
+        if enabled:
+            tracer.enable (app.config['TRACE_SIZE'])
+        else:
+            tracer.disable ()
+    return jsonify (status='ok', response=tracer.enabled)
 
 # error handler
+@app.errorhandler(400)
+def badRequest (e):
+    return jsonify (status='badRequest'), 400
+
 @app.errorhandler(405)
 def invalidMethod (e):
     return jsonify (status='invalidMethod'), 405
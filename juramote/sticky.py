@@ -0,0 +1,134 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Sticky product defaults: Keep customized defaults applied across consecutive
+identical orders instead of patching the EEPROM twice per order.
+"""
+
+import os, json, logging
+from threading import Lock, Timer
+
+from .com import ProductDefaults, Type
+from .decorator import Busy
+from .persist import dumpJson
+
+log = logging.getLogger(__name__)
+
+class StickyDefaults:
+    """
+    Make products with custom defaults, restoring the original defaults
+    lazily: when a different order arrives or after the machine was idle for
+    a while.
+
+    Original values are written to a journal before the EEPROM is changed, so
+    they can be restored on next startup after a crash or power loss.
+    """
+
+    def __init__ (self, machine, journal, timeout=300):
+        """
+        :param machine: Stateful machine
+        :param journal: Path of the restore journal
+        :param timeout: Restore defaults after this many idle seconds
+        """
+        self.machine = machine
+        self.journal = journal
+        self.timeout = timeout
+        self.lock = Lock ()
+        self.timer = None
+        # product → original defaults
+        self.pending = {}
+        # product → defaults currently applied
+        self.applied = {}
+        self._load ()
+
+    def _load (self):
+        if not os.path.exists (self.journal):
+            return
+        with open (self.journal) as fd:
+            for name, values in json.load (fd).items ():
+                self.pending[Type[name]] = ProductDefaults (*values)
+        log.info ('found pending restores for {}'.format (', '.join (p.name for p in self.pending)))
+
+    def _save (self):
+        if not self.pending:
+            if os.path.exists (self.journal):
+                os.unlink (self.journal)
+            return
+        dumpJson (self.journal, dict ((p.name, list (d)) for p, d in self.pending.items ()))
+
+    def _restore (self):
+        for product, defaults in list (self.pending.items ()):
+            self.machine.setProductDefaults (product, defaults)
+            del self.pending[product]
+            self.applied.pop (product, None)
+            self._save ()
+
+    def restore (self):
+        """
+        Restore original defaults now, e.g. those found in the journal at
+        startup
+        """
+        with self.lock:
+            self._cancelTimer ()
+            self._restore ()
+
+    def _cancelTimer (self):
+        if self.timer:
+            self.timer.cancel ()
+            self.timer = None
+
+    def _startTimer (self):
+        self.timer = Timer (self.timeout, self._idle)
+        self.timer.daemon = True
+        self.timer.start ()
+
+    def _idle (self):
+        with self.lock:
+            self.timer = None
+            try:
+                self._restore ()
+            except (Busy, ValueError) as e:
+                log.warning ('restoring defaults failed, retrying: {}'.format (e))
+                self._startTimer ()
+
+    def make (self, product, defaults=None):
+        """
+        Make product, see Stateful.make
+        """
+        if defaults is not None and all (v is None for v in defaults):
+            defaults = None
+
+        with self.lock:
+            self._cancelTimer ()
+            try:
+                sticky = list (self.pending.keys ()) == [product] and \
+                        self.applied.get (product) == defaults
+                if not sticky:
+                    self._restore ()
+                    if defaults:
+                        self.pending[product] = self.machine.getProductDefaults (product)
+                        self._save ()
+                        self.machine.setProductDefaults (product, defaults)
+                        self.applied[product] = defaults
+                return self.machine.make (product)
+            finally:
+                if self.pending:
+                    self._startTimer ()
@@ -0,0 +1,305 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Brew telemetry: sample heater sensors while a product is made and store them
+in compact, append-only column files, one per brew.
+
+File layout (little endian): a header (magic, start time, product name)
+followed by blocks. Each block is a sample count and then one packed array per
+column, so a query only has to read the timestamp column of a block to decide
+whether the rest is needed.
+"""
+
+import os, re, struct, sys, time, logging
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from threading import Thread, Event
+
+from .com import State
+from .decorator import Busy
+
+log = logging.getLogger(__name__)
+
+Sample = namedtuple ('Sample', ['timestamp', 'state', 'flow', 'coffeetemp', 'milktemp', 'raw'])
+
+# number of values returned by HZ:
+RAW_FIELDS = 10
+
+COLUMNS = [('timestamp', 'd'), ('state', 'B'), ('flow', 'H'),
+        ('coffeetemp', 'H'), ('milktemp', 'H')] + \
+        [('raw{}'.format (i), 'H') for i in range (RAW_FIELDS)]
+
+def newColumns ():
+    return dict ((name, array (typecode)) for name, typecode in COLUMNS)
+
+def packColumns (samples):
+    """
+    Transpose samples into one packed, little endian array per column, i.e.
+    the representation of BrewFile blocks
+
+    :return: dict of column name → bytes, see COLUMNS for types
+    """
+    columns = newColumns ()
+    for s in samples:
+        columns['timestamp'].append (s.timestamp)
+        columns['state'].append (s.state.value)
+        columns['flow'].append (s.flow)
+        columns['coffeetemp'].append (s.coffeetemp)
+        columns['milktemp'].append (s.milktemp)
+        for i, v in enumerate (s.raw):
+            columns['raw{}'.format (i)].append (v)
+    return dict ((name, BrewFile._swap (a).tobytes ()) for name, a in columns.items ())
+
+class BrewFile:
+    """
+    Single brew’s telemetry file
+    """
+
+    MAGIC = b'JTM\x01'
+    HEADER = struct.Struct ('<4sdH')
+    COUNT = struct.Struct ('<I')
+    SUFFIX = '.jtm'
+
+    def __init__ (self, path):
+        self.path = path
+        with open (path, 'rb') as fd:
+            magic, self.start, l = self.HEADER.unpack (fd.read (self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError ('not a telemetry file')
+            self.product = fd.read (l).decode ('ascii')
+            self.dataOffset = fd.tell ()
+
+    @classmethod
+    def create (cls, path, product, start):
+        product = product.encode ('ascii')
+        with open (path, 'xb') as fd:
+            fd.write (cls.HEADER.pack (cls.MAGIC, start, len (product)))
+            fd.write (product)
+        return cls (path)
+
+    @staticmethod
+    def _itemsize (typecode):
+        return array (typecode).itemsize
+
+    @staticmethod
+    def _swap (a):
+        if sys.byteorder != 'little':
+            a.byteswap ()
+        return a
+
+    def append (self, columns):
+        """
+        Append a block of samples
+
+        :param columns: dict of arrays, one per column in COLUMNS
+        """
+        count = len (columns['timestamp'])
+        if count == 0:
+            return
+        data = [self.COUNT.pack (count)]
+        for name, typecode in COLUMNS:
+            a = columns[name]
+            assert len (a) == count, name
+            if sys.byteorder != 'little':
+                a = array (typecode, a)
+                a.byteswap ()
+            data.append (a.tobytes ())
+        # a single write, so readers never see half a block header
+        with open (self.path, 'ab') as fd:
+            fd.write (b''.join (data))
+
+    def _readColumn (self, fd, typecode, offset, count):
+        fd.seek (offset)
+        a = array (typecode)
+        a.fromfile (fd, count)
+        return self._swap (a)
+
+    def blocks (self):
+        """
+        Iterate over (offset, count) of all complete blocks
+        """
+        size = os.path.getsize (self.path)
+        rowsize = sum (self._itemsize (t) for _, t in COLUMNS)
+        with open (self.path, 'rb') as fd:
+            offset = self.dataOffset
+            while offset + self.COUNT.size <= size:
+                fd.seek (offset)
+                count, = self.COUNT.unpack (fd.read (self.COUNT.size))
+                end = offset + self.COUNT.size + count*rowsize
+                if end > size:
+                    # block is being written right now
+                    break
+                yield offset + self.COUNT.size, count
+                offset = end
+
+    def query (self, start=None, end=None, step=None):
+        """
+        Iterate over samples, reading one block at a time
+
+        :param start: Only return samples taken at or after this timestamp
+        :param end: Only return samples taken at or before this timestamp
+        :param step: Downsample, return at most one sample per step seconds
+        """
+        bucket = None
+        with open (self.path, 'rb') as fd:
+            for offset, count in self.blocks ():
+                ts = self._readColumn (fd, 'd', offset, count)
+                if start is not None and ts[-1] < start:
+                    continue
+                if end is not None and ts[0] > end:
+                    break
+                lo = bisect_left (ts, start) if start is not None else 0
+                hi = bisect_right (ts, end) if end is not None else count
+
+                columns = []
+                coloffset = offset
+                for name, typecode in COLUMNS:
+                    itemsize = self._itemsize (typecode)
+                    if name == 'timestamp':
+                        columns.append (ts[lo:hi])
+                    else:
+                        columns.append (self._readColumn (fd, typecode,
+                                coloffset + lo*itemsize, hi-lo))
+                    coloffset += count*itemsize
+
+                for row in zip (*columns):
+                    if step:
+                        b = int ((row[0] - self.start)//step)
+                        if b == bucket:
+                            continue
+                        bucket = b
+                    yield Sample (timestamp=row[0], state=State (row[1]),
+                            flow=row[2], coffeetemp=row[3], milktemp=row[4],
+                            raw=list (row[5:]))
+
+class Recorder:
+    """
+    Record heater sensor values at the highest possible rate while a product
+    is made. Only one brew is recorded at a time.
+    """
+
+    # brew ids are generated by us, reject everything else (path traversal)
+    BREW_ID = re.compile (r'^[0-9]+-[a-z_]+$')
+
+    def __init__ (self, machine, path, blocksize=256, timeout=300, startTimeout=10,
+            retryDelay=0.1):
+        """
+        :param machine: Stateful machine
+        :param path: Directory telemetry files are written to
+        :param blocksize: Samples buffered in memory before writing a block
+        :param timeout: Maximum recording time in seconds
+        :param startTimeout: Stop if the machine is still idle after this many seconds
+        :param retryDelay: Seconds to wait after a failed sample
+        """
+        self.machine = machine
+        self.path = path
+        self.blocksize = blocksize
+        self.timeout = timeout
+        self.startTimeout = startTimeout
+        self.retryDelay = retryDelay
+        # (thread, stop event) of the running recording
+        self.active = None
+
+    def start (self, product):
+        """
+        Start recording product in the background, before its button is
+        pressed. Stops the running recording, if any. Returns brew id.
+        """
+        self.stop ()
+        start = time.time ()
+        brew = '{}-{}'.format (int (start*1000), product.name.lower ())
+        f = BrewFile.create (self._filename (brew), product.name, start)
+        stopped = Event ()
+        t = Thread (target=self.record, args=(f, stopped), daemon=True)
+        t.start ()
+        self.active = (t, stopped)
+        return brew
+
+    def stop (self):
+        """
+        Stop the running recording and wait until it is written
+        """
+        if self.active:
+            t, stopped = self.active
+            stopped.set ()
+            t.join ()
+            self.active = None
+
+    def record (self, f, stopped):
+        columns = newColumns ()
+        seenBusy = False
+        while not stopped.is_set ():
+            try:
+                raw, state = self.machine.getHeaterSensorsRaw ()
+            except (Busy, ValueError) as e:
+                log.debug ('skipping sample {}'.format (e))
+                raw = None
+                stopped.wait (self.retryDelay)
+            now = time.time ()
+
+            if raw is not None:
+                columns['timestamp'].append (now)
+                columns['state'].append (state.state.value)
+                columns['flow'].append (state.flow)
+                columns['coffeetemp'].append (state.coffeetemp)
+                columns['milktemp'].append (state.milktemp)
+                for i, v in enumerate (raw):
+                    columns['raw{}'.format (i)].append (v)
+                if len (columns['timestamp']) >= self.blocksize:
+                    f.append (columns)
+                    columns = newColumns ()
+
+                if state.state != State.IDLE:
+                    seenBusy = True
+                elif seenBusy:
+                    break
+            if not seenBusy and now - f.start > self.startTimeout:
+                break
+            if now - f.start > self.timeout:
+                break
+        f.append (columns)
+        log.debug ('finished recording {}'.format (f.path))
+
+    def _filename (self, brew):
+        return os.path.join (self.path, brew + BrewFile.SUFFIX)
+
+    def list (self):
+        """
+        List ids of recorded brews, oldest first
+        """
+        ret = []
+        for name in os.listdir (self.path):
+            brew, ext = os.path.splitext (name)
+            if ext == BrewFile.SUFFIX and self.BREW_ID.match (brew):
+                ret.append (brew)
+        return sorted (ret, key=lambda x: int (x.split ('-', 1)[0]))
+
+    def open (self, brew):
+        """
+        Open recorded brew, raises KeyError if it does not exist
+        """
+        if not self.BREW_ID.match (brew):
+            raise KeyError (brew)
+        try:
+            return BrewFile (self._filename (brew))
+        except FileNotFoundError:
+            raise KeyError (brew)
@@ -0,0 +1,116 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Opt-in span tracing, exported in Chrome’s trace event format (load into
+chrome://tracing or Perfetto).
+"""
+
+import os, time
+from collections import deque
+from threading import get_ident, Lock
+
+class Span:
+    """
+    Time a block, recorded when it is left
+    """
+
+    def __init__ (self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def set (self, **kwargs):
+        """
+        Add arguments, i.e. values known only after the block started
+        """
+        self.args.update (kwargs)
+
+    def __enter__ (self):
+        self.start = time.perf_counter ()
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        end = time.perf_counter ()
+        self.tracer._add (self.name, self.start, end, self.args)
+
+class NullSpan:
+    """
+    Span used while tracing is disabled, does nothing
+    """
+
+    def set (self, **kwargs):
+        pass
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        pass
+
+NULL_SPAN = NullSpan ()
+
+class Tracer:
+    """
+    Records spans into a bounded buffer, oldest spans are dropped first
+    """
+
+    def __init__ (self, size=10000):
+        self.enabled = False
+        self.events = deque (maxlen=size)
+        self.lock = Lock ()
+        self.origin = time.perf_counter ()
+
+    def enable (self, size=None):
+        if size is not None and size != self.events.maxlen:
+            with self.lock:
+                self.events = deque (self.events, maxlen=size)
+        self.enabled = True
+
+    def disable (self):
+        self.enabled = False
+
+    def clear (self):
+        with self.lock:
+            self.events.clear ()
+
+    def span (self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span (self, name, args)
+
+    def _add (self, name, start, end, args):
+        event = {'name': name, 'ph': 'X', 'pid': os.getpid (), 'tid': get_ident (),
+                'ts': (start-self.origin)*1000000, 'dur': (end-start)*1000000}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append (event)
+
+    def export (self):
+        """
+        Get recorded spans as Chrome trace object
+        """
+        with self.lock:
+            events = list (self.events)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+# process-wide tracer
+tracer = Tracer ()
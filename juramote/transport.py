@@ -0,0 +1,277 @@
+# Copyright 2017 juramote contributors (see README)
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Serial transports for Raw: Connect to a serial-over-TCP bridge, record
+traffic of a real connection and replay it later without hardware.
+
+Log file layout (little endian): magic, then one record per run of reads or
+writes, usually a frame, consisting of microseconds since the previous record,
+direction, length and the bytes sent or received on the wire. Empty reads
+(timeouts) get a record of their own.
+"""
+
+import time, struct, socket, logging
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'JRS\x01'
+RECORD = struct.Struct ('<IBH')
+# maximum delay between records, about 71 minutes
+MAX_DELAY = 2**32-1
+MAX_LENGTH = 2**16-1
+WRITE = 0
+READ = 1
+
+class ReplayMismatch (Exception):
+    """
+    Replayed session diverges from the recording
+    """
+    pass
+
+def openSerial (tty, baudrate=9600, timeout=30):
+    """
+    Open TTY path or pyserial URL (rfc2217://, socket://)
+    """
+    if '://' in tty:
+        return NetworkSerial (tty, baudrate, timeout)
+    # pyserial is slow to import, only load it when needed
+    import serial
+    return serial.Serial (tty, baudrate, timeout=timeout)
+
+class NetworkSerial:
+    """
+    Persistent connection to a serial-over-TCP bridge using pyserial’s URL
+    handlers, i.e. rfc2217://host:port or socket://host:port.
+
+    Nagle’s algorithm is disabled, since every command is a small,
+    latency-sensitive frame. After a connection failure the connection is
+    closed and reopened on next use. Failures are raised as ValueError, like
+    timeouts.
+    """
+
+    def __init__ (self, url, baudrate=9600, timeout=30):
+        self.url = url
+        self.baudrate = baudrate
+        self._timeout = timeout
+        self.s = None
+
+    def _connect (self):
+        if self.s is None:
+            # pyserial is slow to import, see openSerial
+            import serial
+            try:
+                s = serial.serial_for_url (self.url, self.baudrate, timeout=self._timeout)
+            except (serial.SerialException, OSError) as e:
+                raise ValueError ('connecting to {} failed: {}'.format (self.url, e))
+            # both socket:// and rfc2217:// keep their socket here
+            sock = getattr (s, '_socket', None)
+            if sock is not None:
+                sock.setsockopt (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            log.debug ('connected to {}'.format (self.url))
+            self.s = s
+        return self.s
+
+    def _call (self, name, *args):
+        s = self._connect ()
+        try:
+            return getattr (s, name) (*args)
+        except OSError as e:
+            # includes serial.SerialException
+            log.warning ('connection to {} failed: {}'.format (self.url, e))
+            self.close ()
+            raise ValueError ('connection failed: {}'.format (e))
+
+    @property
+    def timeout (self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout (self, value):
+        self._timeout = value
+        if self.s is not None:
+            self.s.timeout = value
+
+    def write (self, data):
+        return self._call ('write', data)
+
+    def read (self, size=1):
+        return self._call ('read', size)
+
+    def reset_input_buffer (self):
+        return self._call ('reset_input_buffer')
+
+    def reset_output_buffer (self):
+        return self._call ('reset_output_buffer')
+
+    def close (self):
+        if self.s is not None:
+            try:
+                self.s.close ()
+            except OSError:
+                pass
+            self.s = None
+
+class RecordingSerial:
+    """
+    Wraps a serial.Serial-like object and logs all data sent and received.
+    Consecutive reads or writes are merged into a single record, which is
+    written once the direction changes.
+    """
+
+    def __init__ (self, s, path):
+        self.s = s
+        self.fd = open (path, 'wb')
+        self.fd.write (MAGIC)
+        self.last = time.monotonic ()
+        # (delay, direction, data) not written yet
+        self.pending = None
+
+    def __getattr__ (self, name):
+        return getattr (self.s, name)
+
+    @property
+    def timeout (self):
+        return self.s.timeout
+
+    @timeout.setter
+    def timeout (self, value):
+        self.s.timeout = value
+
+    def _record (self, direction, data):
+        if self.pending:
+            delay, d, buf = self.pending
+            if d == direction and buf and data and len (buf) + len (data) <= MAX_LENGTH:
+                buf += data
+                return
+            self._flush ()
+        now = time.monotonic ()
+        delay = min (int ((now - self.last)*1000000), MAX_DELAY)
+        self.last = now
+        self.pending = (delay, direction, bytearray (data))
+
+    def _flush (self):
+        if self.pending:
+            delay, direction, data = self.pending
+            self.fd.write (RECORD.pack (delay, direction, len (data)))
+            self.fd.write (data)
+            self.fd.flush ()
+            self.pending = None
+
+    def write (self, data):
+        self._record (WRITE, data)
+        return self.s.write (data)
+
+    def read (self, size=1):
+        data = self.s.read (size)
+        self._record (READ, data)
+        return data
+
+    def close (self):
+        self.s.close ()
+        self._flush ()
+        self.fd.close ()
+
+class ReplaySerial:
+    """
+    Serves a recording back, verifying data sent matches the recording.
+
+    Reads and writes may be split differently than during recording. An
+    empty read in the recording (timeout) is replayed as an empty read.
+    """
+
+    def __init__ (self, path, speed=None):
+        """
+        :param path: Log file written by RecordingSerial
+        :param speed: Replay at recorded speed (1), faster (>1) or as fast
+            as possible (None)
+        """
+        with open (path, 'rb') as fd:
+            if fd.read (len (MAGIC)) != MAGIC:
+                raise ValueError ('not a recording')
+            data = fd.read ()
+        self.records = []
+        offset = 0
+        t = 0
+        while offset < len (data):
+            delay, direction, l = RECORD.unpack_from (data, offset)
+            t += delay/1000000
+            offset += RECORD.size
+            self.records.append ((t, direction, data[offset:offset+l]))
+            offset += l
+        self.records.reverse ()
+        self.speed = speed
+        self.timeout = None
+        self.start = time.monotonic ()
+        self.readBuf = b''
+        self.writeBuf = b''
+
+    def _next (self, direction):
+        if not self.records:
+            return None
+        t, d, data = self.records[-1]
+        if d != direction:
+            return None
+        self.records.pop ()
+        if self.speed:
+            wait = self.start + t/self.speed - time.monotonic ()
+            if wait > 0:
+                time.sleep (wait)
+        return data
+
+    def write (self, data):
+        if self.readBuf:
+            raise ReplayMismatch ('write before reading recorded response')
+        expected = data
+        while expected:
+            if not self.writeBuf:
+                rec = self._next (WRITE)
+                if rec is None:
+                    raise ReplayMismatch ('unexpected write {}'.format (data))
+                self.writeBuf = rec
+            l = min (len (expected), len (self.writeBuf))
+            if expected[:l] != self.writeBuf[:l]:
+                raise ReplayMismatch ('expected {}, got {}'.format (self.writeBuf, data))
+            expected = expected[l:]
+            self.writeBuf = self.writeBuf[l:]
+        return len (data)
+
+    def read (self, size=1):
+        if not self.readBuf:
+            rec = self._next (READ)
+            if not rec:
+                # timeout in recording or end of recording
+                return b''
+            self.readBuf = rec
+        data = self.readBuf[:size]
+        self.readBuf = self.readBuf[size:]
+        return data
+
+    def reset_input_buffer (self):
+        # discard the rest of the response, like a real port
+        self.readBuf = b''
+        while self.records and self.records[-1][1] == READ:
+            self.records.pop ()
+
+    def reset_output_buffer (self):
+        pass
+
+    def close (self):
+        pass